@@ -2,92 +2,599 @@ import os
 import glob
 import json
 import sys
-from bs4 import BeautifulSoup
-from openai import OpenAI
+import asyncio
+import time
+import random
+import hashlib
+import re
+import sqlite3
+import copy
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import orjson
+import openai
+import tiktoken
+from lxml import etree, html as lxml_html
+from openai import AsyncOpenAI
 
-client = OpenAI()
-MODEL = "gpt-4o"
+client = AsyncOpenAI(max_retries=0)  # Retries are handled by call_with_backoff
+MODEL = "gpt-4o-mini"  # Cheap first pass for every table
+FALLBACK_MODEL = "gpt-4o"  # Re-audits only the tables that fail validation
 MAX_RETRIES = 3  # How many times to try to self-heal before giving up
+BALANCE_SHEETS_ONLY = False  # Set True to skip tables with no balance-sheet wording instead of sending them to the model
+BALANCE_SHEET_PATTERN = re.compile(r'total\s+(assets|liabilities)|net\s+assets', re.IGNORECASE)
+MAX_CONCURRENT_REQUESTS = 10  # Cap on in-flight OpenAI requests across all files
+llm_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+RATE_LIMITS = {MODEL: (500, 200000), FALLBACK_MODEL: (500, 30000)}  # (RPM, TPM) per model, OpenAI tier 1; raise for higher tiers
+ENCODING = tiktoken.encoding_for_model(MODEL)
+RETRYABLE_API_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+API_MAX_ATTEMPTS = 5
+API_MAX_BACKOFF_SECONDS = 32
+CACHE_PATH = ".llm_cache.sqlite"  # Exact-match response cache shared across runs
+CACHE_TTL_SECONDS = 30 * 24 * 60 * 60
+cache_db = sqlite3.connect(CACHE_PATH)
+cache_db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, content TEXT NOT NULL, created_at REAL NOT NULL)")
+SEMANTIC_CACHE_ENABLED = False  # Opt-in: near-duplicate tables may differ only in their figures
+SEMANTIC_CACHE_THRESHOLD = 0.97  # Cosine similarity needed to reuse a cached extraction
+SEMANTIC_CACHE_DIR = ".semantic_cache"
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_MAX_TOKENS = 8000
+TABLE_TOKEN_LIMIT = 4000  # Tables are sent as compact text, cut off at this many tokens
+RULER_LINE = re.compile(r'^[\s\-=_]*$')
+DOT_LEADER = re.compile(r'(?<=\.)\.{2,}')
+RAW_TEXT_TAG = re.compile(rb'<(/?(?:plaintext|xmp|listing)\b)', re.IGNORECASE)  # libxml2 hides all later tags after these
+RAW_TEXT_TAG_MAX_LENGTH = len(b'</plaintext>')
+READ_BLOCK_SIZE = 1 << 16
+# Batches hold at most BATCH_MAX_TABLES tables and an estimated answer (JSON re-quotes every cell: ~2x the table
+# text, plus a fixed cost per table) of at most half of gpt-4o-mini's 16k output cap
+BATCH_MAX_TABLES = 8
+BATCH_OUTPUT_TOKEN_BUDGET = 8000
+ANSWER_TOKENS_PER_TABLE_TOKEN = 2
+ANSWER_TOKENS_PER_TABLE = 50
 
-def extract_tables_from_html(file_content):
-    """Parses HTML and finds table blocks."""
-    soup = BeautifulSoup(file_content, 'html.parser')
-    tables = soup.find_all('table')
+# Structured Outputs schema: answers always parse and always carry the keys the validator needs.
+# Strict schemas can't have free-form keys, so each row lists its values in the order of "headers".
+TABLE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "table_type": {"type": "string"},
+        "total_assets": {"type": ["number", "null"]},
+        "total_liabilities": {"type": ["number", "null"]},
+        "net_assets": {"type": ["number", "null"]},
+        "headers": {"type": "array", "items": {"type": "string"}},
+        "rows": {"type": "array", "items": {"type": "array", "items": {"type": ["string", "null"]}}}
+    },
+    "required": ["table_type", "total_assets", "total_liabilities", "net_assets", "headers", "rows"],
+    "additionalProperties": False
+}
+BATCH_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "results": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"id": {"type": "integer"}, **TABLE_SCHEMA["properties"]},
+                "required": ["id"] + TABLE_SCHEMA["required"],
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["results"],
+    "additionalProperties": False
+}
+TABLE_RESPONSE_FORMAT = {"type": "json_schema", "json_schema": {"name": "audited_table", "strict": True, "schema": TABLE_SCHEMA}}
+BATCH_RESPONSE_FORMAT = {"type": "json_schema", "json_schema": {"name": "audited_tables", "strict": True, "schema": BATCH_SCHEMA}}
+
+class RateLimiter:
+    """
+    Token-bucket limiter for OpenAI's requests-per-minute and tokens-per-minute caps.
+    Callers pre-debit their prompt size so we wait locally instead of eating 429 backoffs.
+    """
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.request_capacity = requests_per_minute
+        self.token_capacity = tokens_per_minute
+        self.available_requests = requests_per_minute
+        self.available_tokens = tokens_per_minute
+        self.last_refill = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed_minutes = (now - self.last_refill) / 60
+        self.last_refill = now
+        self.available_requests = min(self.request_capacity, self.available_requests + elapsed_minutes * self.request_capacity)
+        self.available_tokens = min(self.token_capacity, self.available_tokens + elapsed_minutes * self.token_capacity)
+
+    async def acquire(self, tokens):
+        # A single oversized prompt can never exceed the bucket, so clamp it to a full minute's budget
+        tokens = min(tokens, self.token_capacity)
+        # Holding the lock while sleeping keeps waiters in FIFO order
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.available_requests >= 1 and self.available_tokens >= tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= tokens
+                    return
+                missing_requests = max(0, 1 - self.available_requests) / self.request_capacity
+                missing_tokens = max(0, tokens - self.available_tokens) / self.token_capacity
+                await asyncio.sleep(max(missing_requests, missing_tokens) * 60)
+
+rate_limiters = {model: RateLimiter(rpm, tpm) for model, (rpm, tpm) in RATE_LIMITS.items()}
+
+def count_message_tokens(messages):
+    """Approximate prompt size of a chat request, used to pre-debit the token bucket."""
+    return sum(len(ENCODING.encode(message["content"])) for message in messages)
+
+def prompt_cache_key(model, messages, response_format):
+    """Exact-match key for a request: same model + schema + conversation => same answer at temperature 0."""
+    return hashlib.blake2b((model + json.dumps(response_format) + json.dumps(messages)).encode()).hexdigest()
+
+def cache_get(key):
+    row = cache_db.execute("SELECT content, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+    if row is None or time.time() - row[1] > CACHE_TTL_SECONDS:
+        return None
+    return row[0]
+
+def cache_set(key, content):
+    cache_db.execute("INSERT OR REPLACE INTO responses (key, content, created_at) VALUES (?, ?, ?)", (key, content, time.time()))
+    cache_db.commit()
+
+def table_cache_key(table_text):
+    """Key of the one-table first-pass request, used for a table however it was extracted, so equal text => equal key."""
+    return prompt_cache_key(MODEL, table_messages(table_text), TABLE_RESPONSE_FORMAT)
+
+def cached_table_result(table_text):
+    """First-pass extraction of this exact table from an earlier request, if it passes validation; else None."""
+    cached = cache_get(table_cache_key(table_text))
+    if cached is None:
+        return None
+    extracted_data = orjson.loads(cached)
+    if validate_financial_logic(extracted_data) is not None:
+        return None
+    extracted_data["validation_status"] = "passed"
+    extracted_data["attempts_needed"] = 1
+    return extracted_data
+
+class SemanticCache:
+    """
+    Reuses the extraction of a near-duplicate table: embeddings of previously seen
+    tables are kept L2-normalized, so a dot product against them is cosine similarity.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.vectors_path = os.path.join(directory, "vectors.npy")
+        self.responses_path = os.path.join(directory, "responses.json")
+        self.vectors = None
+        self.responses = []
+        if os.path.exists(self.vectors_path) and os.path.exists(self.responses_path):
+            self.vectors = np.load(self.vectors_path)
+            with open(self.responses_path, 'r') as f:
+                self.responses = json.load(f)
+
+    def lookup(self, vector):
+        if not self.responses:
+            return None
+        scores = self.vectors @ vector
+        best = int(np.argmax(scores))
+        if scores[best] < SEMANTIC_CACHE_THRESHOLD:
+            return None
+        return copy.deepcopy(self.responses[best])
+
+    def add(self, vector, response):
+        row = vector.reshape(1, -1)
+        self.vectors = row if self.vectors is None else np.vstack([self.vectors, row])
+        self.responses.append(copy.deepcopy(response))
+
+    def save(self):
+        if self.vectors is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        np.save(self.vectors_path, self.vectors)
+        with open(self.responses_path, 'w') as f:
+            json.dump(self.responses, f)
+
+semantic_cache = SemanticCache(SEMANTIC_CACHE_DIR) if SEMANTIC_CACHE_ENABLED else None
+in_flight_tables = {}  # md5 of table text -> future of its result; filings in the same run share repeated tables
+
+def has_significant_text(table):
+    """True once the table's stripped text passes 100 chars; stops walking the text at that point."""
+    total = 0
+    for text in table.itertext():
+        total += len(text.strip())
+        if total > 100:
+            return True
+    return False
+
+def read_filing_blocks(file_path):
+    """Filing bytes block by block, raw-text tags escaped; a tag cut off at a block's end waits for the next block."""
+    with open(file_path, 'rb') as f:
+        pending = b''
+        for block in iter(lambda: f.read(READ_BLOCK_SIZE), b''):
+            data = pending + block
+            split = data.rfind(b'<', max(0, len(data) - RAW_TEXT_TAG_MAX_LENGTH))
+            if split == -1:
+                split = len(data)
+            pending = data[split:]
+            yield RAW_TEXT_TAG.sub(rb'&lt;\1', data[:split])
+        yield RAW_TEXT_TAG.sub(rb'&lt;\1', pending)
+
+def extract_tables_from_html(file_path):
+    """Stream-parses the filing and finds table blocks, freeing each one once it has been read."""
     significant_tables = []
-    for table in tables:
-        if len(table.get_text(strip=True)) > 100:
-            significant_tables.append(str(table))
+    parser = etree.HTMLPullParser(events=('end',), tag='table', recover=True, encoding='utf-8')
+
+    def take_closed_tables():
+        for _, table in parser.read_events():
+            if has_significant_text(table):
+                significant_tables.append(etree.tostring(table, encoding='unicode', method='html', with_tail=False))
+            # Nested tables are freed along with their outermost table
+            if not any(ancestor.tag == 'table' for ancestor in table.iterancestors()):
+                table.clear(keep_tail=True)
+                while table.getprevious() is not None:
+                    del table.getparent()[0]
+
+    for data in read_filing_blocks(file_path):
+        parser.feed(data)
+        take_closed_tables()
+    parser.close()  # Also closes a table left open at the end of the file
+    take_closed_tables()
     return significant_tables
 
+def compact_table(table_html):
+    """
+    Table as plain text ('cell | cell' per row; fixed-width SGML tables keep their column layout
+    minus rulers, dot leaders and common indent), cut at TABLE_TOKEN_LIMIT tokens rather than mid-tag.
+    """
+    table = lxml_html.fragment_fromstring(table_html)
+    lines = []
+    rows = list(table.iter('tr'))
+    if rows:
+        for row in rows:
+            cells = [" ".join(cell.text_content().split()) for cell in row if cell.tag in ('td', 'th')]
+            cells = [cell for cell in cells if cell]
+            if cells:
+                lines.append(" | ".join(cells))
+    else:
+        # Fixed-width table: a value's column is given only by its character position, so the layout is
+        # kept as is. Ruler lines and <S>/<C> marker lines (blank once the tags are gone) are dropped,
+        # dot leaders become spaces of the same width, and the indent shared by every line is removed.
+        for line in table.text_content().expandtabs().splitlines():
+            if not RULER_LINE.match(line):
+                lines.append(DOT_LEADER.sub(lambda leader: " " * len(leader.group()), line.rstrip()))
+        indent = min((len(line) - len(line.lstrip()) for line in lines), default=0)
+        lines = [line[indent:] for line in lines]
+    tokens = ENCODING.encode("\n".join(lines))
+    return ENCODING.decode(tokens[:TABLE_TOKEN_LIMIT])
+
+def load_tables(file_path):
+    """Significant tables of a filing, already in compact prompt form."""
+    return [compact_table(table_html) for table_html in extract_tables_from_html(file_path)]
+
 def validate_financial_logic(data):
     """
     Performs hard logic checks on the extracted JSON.
     Returns None if valid, or an error string if invalid.
     """
-    # 1. Check if the LLM identified this as a Balance Sheet / Assets & Liabilities
-    table_type = data.get("table_type", "").lower()
-    
-    if "balance sheet" in table_type or "assets and liabilities" in table_type:
+    return validate_financial_logic_batch([data])[0]
+
+def validate_financial_logic_batch(records):
+    """
+    Same checks as validate_financial_logic, over many extractions at once.
+    The figures are gathered into arrays so the math check is one vectorized sweep.
+    Returns one entry per record: None if valid, or an error string if invalid.
+    """
+    errors = [None] * len(records)
+    checked, assets, liabilities, net_assets = [], [], [], []
+
+    for i, data in enumerate(records):
+        # 1. Check if the LLM identified this as a Balance Sheet / Assets & Liabilities
+        table_type = str(data.get("table_type") or "").lower()
+        if "balance sheet" not in table_type and "assets and liabilities" not in table_type:
+            continue
         try:
             # Safely get values, defaulting to 0 if missing (but we want them to exist)
-            assets = float(str(data.get("total_assets", 0)).replace(',', ''))
-            liabilities = float(str(data.get("total_liabilities", 0)).replace(',', ''))
-            net_assets = float(str(data.get("net_assets", 0)).replace(',', ''))
-            
-            # THE MATH CHECK: Assets should equal Liabilities + Net Assets
-            # We use a small epsilon (0.1) for floating point rounding safety
-            calculated_total = liabilities + net_assets
-            difference = abs(assets - calculated_total)
-            
-            if difference > 1.0: # Allow $1 variance for rounding
-                return f"Math Error: Total Assets ({assets}) does not equal Liabilities ({liabilities}) + Net Assets ({net_assets}). Difference is {difference}."
-            
+            row = [float(str(data.get(key, 0)).replace(',', '')) for key in ("total_assets", "total_liabilities", "net_assets")]
         except ValueError:
-            return "Validation Error: Could not convert financial fields to numbers."
+            errors[i] = "Validation Error: Could not convert financial fields to numbers."
+            continue
         except Exception as e:
-            return f"Validation Error: {str(e)}"
+            errors[i] = f"Validation Error: {str(e)}"
+            continue
+        checked.append(i)
+        assets.append(row[0])
+        liabilities.append(row[1])
+        net_assets.append(row[2])
+
+    if checked:
+        # THE MATH CHECK: Assets should equal Liabilities + Net Assets
+        assets = np.array(assets, dtype=np.float64)
+        liabilities = np.array(liabilities, dtype=np.float64)
+        net_assets = np.array(net_assets, dtype=np.float64)
+        difference = np.abs(assets - (liabilities + net_assets))
+        # Allow $1 variance for rounding; only the failures need a message
+        for k in np.flatnonzero(difference > 1.0):
+            errors[checked[k]] = f"Math Error: Total Assets ({assets[k]}) does not equal Liabilities ({liabilities[k]}) + Net Assets ({net_assets[k]}). Difference is {difference[k]}."
 
     # we can add other validators here like the Schedule of Investments summation
-    
-    return None # No errors found
 
-def process_table_agentic_loop(table_html, filename):
+    return errors
+
+async def call_with_backoff(make_request):
     """
-    The Agentic Loop: Extracts, Validates, and Retries if necessary.
+    Awaits make_request(), retrying transient API failures (rate limits, timeouts,
+    dropped connections, 5xx) with randomized exponential backoff. Anything else,
+    e.g. a BadRequestError, is raised immediately.
     """
-    
-    system_prompt = "You are a specialized financial auditor. You extract data precisely."
+    for attempt in range(API_MAX_ATTEMPTS):
+        try:
+            return await make_request()
+        except RETRYABLE_API_ERRORS as e:
+            if attempt == API_MAX_ATTEMPTS - 1:
+                raise
+            delay = random.uniform(1, min(API_MAX_BACKOFF_SECONDS, 2 ** attempt))
+            print(f"      ! Transient API error ({type(e).__name__}), retrying in {delay:.1f}s...")
+            await asyncio.sleep(delay)
+
+async def request_completion(messages, response_format, model=MODEL):
+    """
+    Sends a schema-constrained chat request, bounded by the concurrency semaphore and the model's
+    rate limiter, and returns the parsed JSON answer. Identical requests are answered from the
+    on-disk cache without touching the API; truncated, refused or empty answers raise ValueError
+    and are never cached.
+    """
+    cache_key = prompt_cache_key(model, messages, response_format)
+    cached = cache_get(cache_key)
+    if cached is not None:
+        return orjson.loads(cached)
+
+    prompt_tokens = count_message_tokens(messages)
+
+    async def send():
+        # Wait for rate-limit budget before taking a concurrency slot, so a request throttled
+        # on its bucket never holds a slot that other requests (or other models) could use
+        await rate_limiters[model].acquire(prompt_tokens)
+        async with llm_semaphore:
+            stream = await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                response_format=response_format,
+                temperature=0,
+                stream=True
+            )
+            # Tokens arrive from time-to-first-token onwards instead of all at once at the end;
+            # the event loop keeps serving other requests between chunks
+            parts, refusal, finish_reason = [], [], None
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                if choice.delta.content:
+                    parts.append(choice.delta.content)
+                if choice.delta.refusal:
+                    refusal.append(choice.delta.refusal)
+                if choice.finish_reason:
+                    finish_reason = choice.finish_reason
+        # Refusals and answers cut off at the output cap still stream cleanly; check how it ended
+        if refusal:
+            raise ValueError(f"Model refused the request: {''.join(refusal)}")
+        if finish_reason != "stop":
+            raise ValueError(f"Incomplete response (finish_reason={finish_reason})")
+        content = "".join(parts)
+        if not content:
+            raise ValueError("Empty response")
+        return content
+
+    content = await call_with_backoff(send)
+    response = orjson.loads(content)  # Only answers that parse are cached
+    cache_set(cache_key, content)
+    return response
+
+async def semantic_lookup(table_text):
+    """
+    Embeds the table's visible text and searches the semantic cache.
+    Returns (vector, cached_result); both are None when the cache is disabled or unreachable.
+    """
+    if not SEMANTIC_CACHE_ENABLED:
+        return None, None
+    text = " ".join(table_text.split())
+    text = ENCODING.decode(ENCODING.encode(text)[:EMBEDDING_MAX_TOKENS])
+    try:
+        async def send():
+            async with llm_semaphore:
+                return await client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+        response = await call_with_backoff(send)
+    except Exception as e:
+        print(f"      ! Embedding failed, skipping semantic cache: {e}")
+        return None, None
+    vector = np.asarray(response.data[0].embedding, dtype=np.float32)
+    vector /= np.linalg.norm(vector)
+    return vector, semantic_cache.lookup(vector)
+
+# Static prompt prefix (system + instructions), identical for every request so that OpenAI's
+# automatic prompt caching (1024+ token prefixes) applies; only the trailing table message varies.
+SYSTEM_PROMPT = "You are a specialized financial auditor. You extract data precisely."
+AUDIT_INSTRUCTIONS = """
+You audit tables taken from SEC N-CSR and N-CSRS filings, the annual and semi-annual
+shareholder reports of registered management investment companies (closed-end funds,
+mutual funds). Your extractions are checked by deterministic code afterwards, so exact
+figures matter more than anything else.
+
+Each table is plain text with one table row per line. Tables that were HTML have the columns
+of each row separated by ' | '. Tables that were fixed-width SGML text keep their original
+layout with no separator: a value belongs to the column header it sits under, by character
+position, even when the columns before it are blank, and a "$" in front of a figure is part of
+that figure, not a column of its own. Leading spaces before a row label are the original
+indentation and usually mean the row is a sub-item of the closest less-indented row above it.
+Ruler lines of dashes or equals signs and dot leaders have been removed. Very long tables may
+have been cut off at the end; extract what is present and never invent the rest.
+
+Goal: Extract into JSON.
+
+CRITICAL SCHEMA RULES:
+1. Identify 'table_type'. Prefer one of these names when it fits:
+   - "Balance Sheet" (also printed as "Statement of Assets and Liabilities")
+   - "Schedule of Investments" (holdings with shares or principal amounts and values)
+   - "Operations" (statement of operations: investment income, expenses, gains and losses)
+   - "Changes in Net Assets" (statement of changes in net assets, usually two periods)
+   - "Financial Highlights" (per-share data and ratios, usually several years)
+   - "Portfolio Summary" (sector, industry or top-ten holdings breakdowns)
+   - "Other" (anything else: officer and director listings, cover pages, indexes, notes text)
+2. If it is a Balance Sheet, you MUST extract keys: "total_assets", "total_liabilities", "net_assets".
+   - "total_assets" is the line labelled "Total Assets" (or the single figure for all assets).
+   - "total_liabilities" is the line labelled "Total Liabilities". If the table only lists the
+     liabilities without a total, add them up from the table as printed.
+   - "net_assets" is "Net Assets" (sometimes "Net Assets Applicable to Common Stock").
+   - For any other table type these three keys are null.
+   - The three must satisfy total_assets = total_liabilities + net_assets. The same figures are
+     re-checked afterwards, so read them from the table; never adjust them to force the check.
+   - When the balance sheet shows more than one date, use the most recent period for these keys.
+3. Remove commas from numbers. Also drop currency symbols: "$1,253,973,815" becomes
+   1253973815. Amounts in parentheses are negative: "(1,234)" becomes -1234.
+   Percentages keep their percent sign. A dash or blank where a value belongs is null.
+4. For every table, also extract the table itself: "headers" is the list of column names in
+   order (call an unnamed label column "Description"), and "rows" holds one list per data row
+   with its values in the same order as "headers". Row values are strings, cleaned as in rule 3.
+5. Never round or re-total figures other than as described in rule 2.
+6. Return ONLY a JSON object with the keys "table_type", "total_assets", "total_liabilities",
+   "net_assets", "headers" and "rows".
+
+Example input:
+Assets
+Investments* at value:
+  Common stocks (cost $773,592,739)                          $923,393,949
+  Securities lending collateral (cost $166,977,546)           166,977,546 $1,244,502,023
+Cash                                                                              133,088
+Prepaid expenses and other assets                                               6,901,725
+    Total Assets                                                            1,253,973,815
+Liabilities
+Obligations to return securities lending collateral                           166,977,546
+Accrued expenses                                                                2,667,154
+    Total Liabilities                                                         171,568,113
+    Net Assets                                                             $1,082,405,702
+
+Example output:
+{
+  "table_type": "Balance Sheet",
+  "total_assets": 1253973815,
+  "total_liabilities": 171568113,
+  "net_assets": 1082405702,
+  "headers": ["Description", "Detail", "Amount"],
+  "rows": [
+    ["Assets", null, null],
+    ["Investments at value:", null, null],
+    ["Common stocks (cost $773,592,739)", "923393949", null],
+    ["Securities lending collateral (cost $166,977,546)", "166977546", "1244502023"],
+    ["Cash", null, "133088"],
+    ["Prepaid expenses and other assets", null, "6901725"],
+    ["Total Assets", null, "1253973815"],
+    ["Liabilities", null, null],
+    ["Obligations to return securities lending collateral", null, "166977546"],
+    ["Accrued expenses", null, "2667154"],
+    ["Total Liabilities", null, "171568113"],
+    ["Net Assets", null, "1082405702"]
+  ]
+}
+
+Example input:
+Investment Income
+Dividends | $8,954,207
+Interest | 866,481
+    Total income | 9,820,688
+Expenses | 2,704,827
+Net Investment Income | 7,115,861
+Change in Net Assets Resulting from Operations | $83,680,229
+
+Example output:
+{
+  "table_type": "Operations",
+  "total_assets": null,
+  "total_liabilities": null,
+  "net_assets": null,
+  "headers": ["Description", "Amount"],
+  "rows": [
+    ["Investment Income", null],
+    ["Dividends", "8954207"],
+    ["Interest", "866481"],
+    ["Total income", "9820688"],
+    ["Expenses", "2704827"],
+    ["Net Investment Income", "7115861"],
+    ["Change in Net Assets Resulting from Operations", "83680229"]
+  ]
+}
+
+Example input:
+Shares | Value (A)
+Stocks -- 88.9%
+Energy -- 7.9%
+  BP plc ADR | 400,000 | $16,880,000
+  Exxon Mobil Corporation | 575,000 | 20,413,000
+
+Example output:
+{
+  "table_type": "Schedule of Investments",
+  "total_assets": null,
+  "total_liabilities": null,
+  "net_assets": null,
+  "headers": ["Description", "Shares", "Value"],
+  "rows": [
+    ["Stocks -- 88.9%", null, null],
+    ["Energy -- 7.9%", null, null],
+    ["BP plc ADR", "400000", "16880000"],
+    ["Exxon Mobil Corporation", "575000", "20413000"]
+  ]
+}
+"""
+
+def table_messages(table_text):
+    """Opening messages for one table. The table is the only variable part, so repeats across filings share a cache key."""
     base_prompt = f"""
-    Analyze this HTML table from file: {filename}.
+    Analyze this table.
     
-    Goal: Extract into JSON.
-    
-    CRITICAL SCHEMA RULES:
-    1. Identify 'table_type'.
-    2. If it is a Balance Sheet, you MUST extract keys: "total_assets", "total_liabilities", "net_assets".
-    3. Remove commas from numbers.
-    
-    HTML:
-    {table_html[:15000]}
+    TABLE:
+    {table_text}
     """
-
-    messages = [
-        {"role": "system", "content": system_prompt},
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": AUDIT_INSTRUCTIONS},
         {"role": "user", "content": base_prompt}
     ]
 
-    for attempt in range(MAX_RETRIES):
-        print(f"      > Attempt {attempt + 1}...")
+def audit_feedback(extracted_data, error_message):
+    """The wrong answer and the validator's complaint, as history for the next self-healing attempt."""
+    return [
+        {"role": "assistant", "content": orjson.dumps(extracted_data).decode()},
+        {
+            "role": "user",
+            "content": f"AUDIT FAILURE: {error_message}. Please re-examine the table and fix your JSON output to satisfy the math check."
+        }
+    ]
+
+async def process_table_agentic_loop(table_text, filename, failed_attempt=None):
+    """
+    The Agentic Loop: Extracts, Validates, and Retries if necessary.
+    failed_attempt is an (extraction, error) pair from the batched first pass; the loop then
+    picks up from that answer and goes straight to the fallback model.
+    """
+    messages = table_messages(table_text)
+    extracted_data = None
+    first_attempt = 0
+    if failed_attempt is not None:
+        extracted_data, error_message = failed_attempt
+        messages += audit_feedback(extracted_data, error_message)
+        first_attempt = 1
+
+    # MAX_RETRIES only governs self-healing after failed validation; transient
+    # transport errors are already retried with backoff inside request_completion
+    for attempt in range(first_attempt, MAX_RETRIES):
+        print(f"      > {filename}: Attempt {attempt + 1}...")
         
         # 1. Call LLM
         try:
-            response = client.chat.completions.create(
-                model=MODEL,
-                messages=messages,
-                response_format={"type": "json_object"},
-                temperature=0
-            )
-            extracted_data = json.loads(response.choices[0].message.content)
+            # Cheap model first; self-healing re-audits escalate to the stronger model
+            model = MODEL if attempt == 0 else FALLBACK_MODEL
+            extracted_data = await request_completion(messages, TABLE_RESPONSE_FORMAT, model)
             
             # 2. Deterministic Validation (Python checks the Math)
             error_message = validate_financial_logic(extracted_data)
@@ -102,30 +609,230 @@ def process_table_agentic_loop(table_html, filename):
             
             # 4. The "Self-Healing" Step: Feed error back to LLM
             # We append the assistant's wrong answer and our error message to history
-            messages.append({"role": "assistant", "content": json.dumps(extracted_data)})
-            messages.append({
-                "role": "user", 
-                "content": f"AUDIT FAILURE: {error_message}. Please re-examine the table image and fix your JSON output to satisfy the math check."
-            })
+            messages += audit_feedback(extracted_data, error_message)
             
         except Exception as e:
+            # The API call itself failed (after backoff) -- re-prompting won't help
             print(f"      ! API Error: {e}")
-            break
+            error = {"error": str(e), "table_snippet": table_text[:100], "last_attempt": extracted_data}
+            if isinstance(e, RETRYABLE_API_ERRORS):
+                error["transient"] = True  # Outage outlasting the backoff; truncation, refusals etc. would fail again
+            return error
 
     # If we exhaust retries, mark as failed but return what we have
     print("      ! Exhausted retries. Returning last attempt.")
-    return {"error": "Validation failed after max retries", "last_attempt": extracted_data}
+    return {"error": "Validation failed after max retries", "validation_status": "failed", "last_attempt": extracted_data}
+
+def pack_into_batches(tables):
+    """Greedily groups consecutive table indexes, capped by BATCH_MAX_TABLES and the estimated answer size."""
+    batches = []
+    current_batch, current_tokens = [], 0
+    for i, table_text in enumerate(tables):
+        tokens = ANSWER_TOKENS_PER_TABLE_TOKEN * len(ENCODING.encode(table_text)) + ANSWER_TOKENS_PER_TABLE
+        if current_batch and (len(current_batch) == BATCH_MAX_TABLES or current_tokens + tokens > BATCH_OUTPUT_TOKEN_BUDGET):
+            batches.append(current_batch)
+            current_batch, current_tokens = [], 0
+        current_batch.append(i)
+        current_tokens += tokens
+    if current_batch:
+        batches.append(current_batch)
+    return batches
+
+async def process_table_batch(tables):
+    """
+    Extracts several tables with a single request and validates each answer.
+    Returns (results, failures): one result per table, None marking tables that need the agentic
+    loop, and {index: (extraction, error)} for the answers that failed the math check.
+    Answers that pass are cached under each table's own key.
+    """
+    if len(tables) == 1:
+        # A lone table skips the batch envelope: the agentic loop's first attempt is the plain
+        # one-table request, with the same code path and cache entry as any other single table
+        return [None], {}
 
-def main(input_path):
-    # This list will hold all extracted data from all files.
-    # The script accumulates data in memory and writes it to a single JSON file at the very end.
-    all_data = []
+    payload = json.dumps({"tables": [{"id": i, "rows": table_text} for i, table_text in enumerate(tables)]})
+    batch_prompt = f"""
+    Analyze each table below.
+    
+    Apply the rules above to every table and return {{"results": [{{"id": <table id>, ...extracted table...}}]}}
+    with exactly one entry per input table.
     
+    Tables (JSON, each with an 'id' and its 'rows'):
+    {payload}
+    """
+
+    try:
+        response = await request_completion([
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": AUDIT_INSTRUCTIONS},
+            {"role": "user", "content": batch_prompt}
+        ], BATCH_RESPONSE_FORMAT)
+        results_by_id = {}
+        for result in response.get("results", []):
+            if isinstance(result, dict) and "id" in result:
+                results_by_id[int(result.pop("id"))] = result
+    except Exception as e:
+        print(f"      ! Batch of {len(tables)} failed, falling back to agentic loop per table: {e}")
+        return [None] * len(tables), {}
+
+    # Validate the whole batch in one vectorized pass
+    returned_ids = [i for i in range(len(tables)) if i in results_by_id]
+    validation_errors = dict(zip(returned_ids, validate_financial_logic_batch([results_by_id[i] for i in returned_ids])))
+
+    results, failures = [], {}
+    for i in range(len(tables)):
+        extracted_data = results_by_id.get(i)
+        if extracted_data is not None and validation_errors[i] is None:
+            cache_set(table_cache_key(tables[i]), orjson.dumps(extracted_data).decode())
+            extracted_data["validation_status"] = "passed"
+            extracted_data["attempts_needed"] = 1
+            results.append(extracted_data)
+        else:
+            # Missing or failed the math check: let the agentic loop self-heal it on its own,
+            # starting from this answer when there is one
+            if extracted_data is not None:
+                failures[i] = (extracted_data, validation_errors[i])
+            results.append(None)
+    return results, failures
+
+async def extract_unique_tables(tables, filename):
+    """Extracts and validates a filing's distinct tables, batching tables per request. One result per table."""
+    # Cheap keyword scan first: officer bios, indexes etc. never mention assets/liabilities,
+    # so they are marked as skipped without any API call
+    extracted_tables = [None] * len(tables)
+    if BALANCE_SHEETS_ONLY:
+        for i, table in enumerate(tables):
+            if not BALANCE_SHEET_PATTERN.search(table):
+                extracted_tables[i] = {"table_type": "Other", "skipped": True}
+    candidates = [i for i, result in enumerate(extracted_tables) if result is None]
+    if BALANCE_SHEETS_ONLY:
+        print(f"  - {len(tables) - len(candidates)} tables of {filename} skipped as non-financial.")
+
+    # Tables already validated, in an earlier run or another filing, come from the on-disk cache;
+    # look-alike tables we've already validated come straight from the semantic cache
+    for i in candidates:
+        extracted_tables[i] = cached_table_result(tables[i])
+    uncached = [i for i in candidates if extracted_tables[i] is None]
+    lookups = dict(zip(uncached, await asyncio.gather(*(semantic_lookup(tables[i]) for i in uncached))))
+    for i, (_, cached) in lookups.items():
+        extracted_tables[i] = cached
+    pending = [i for i in uncached if extracted_tables[i] is None]
+
+    # First pass: several tables per request, all batches in flight together
+    batches = pack_into_batches([tables[i] for i in pending])
+    batch_results = await asyncio.gather(
+        *(process_table_batch([tables[pending[j]] for j in batch]) for batch in batches)
+    )
+    failed_attempts = {}
+    for batch, (results, failures) in zip(batches, batch_results):
+        for j, result in zip(batch, results):
+            extracted_tables[pending[j]] = result
+        for j, failure in failures.items():
+            failed_attempts[pending[batch[j]]] = failure
+
+    # Second pass: lone tables and tables missing from the batched answer run their own agentic loop; tables that failed
+    # validation in it resume from that answer and escalate straight to the fallback model
+    needs_loop = [i for i in pending if extracted_tables[i] is None]
+    if needs_loop:
+        print(f"    - {len(needs_loop)} tables of {filename} need the agentic loop...")
+    loop_results = await asyncio.gather(
+        *(process_table_agentic_loop(tables[i], filename, failed_attempts.get(i)) for i in needs_loop)
+    )
+    for i, result in zip(needs_loop, loop_results):
+        extracted_tables[i] = result
+
+    # Only validated extractions are worth reusing for look-alike tables
+    for i in pending:
+        vector = lookups[i][0]
+        if vector is not None and extracted_tables[i].get("validation_status") == "passed":
+            semantic_cache.add(vector, extracted_tables[i])
+
+    return extracted_tables
+
+async def process_file(file_path, parse_pool):
+    """Extracts every table of one filing, batching tables per request. Returns None on failure."""
+    filename = os.path.basename(file_path)
+    print(f"Processing: {file_path}")
+    try:
+        # Reading + parsing is CPU-bound, so it runs in a worker process and never stalls the event loop
+        tables = await asyncio.get_running_loop().run_in_executor(parse_pool, load_tables, file_path)
+        print(f"  - Found {len(tables)} tables in {filename}.")
+    except Exception as e:
+        print(f"Failed file {file_path}: {e}")
+        return None
+
+    # Identical tables are extracted once, within this filing and across the filings in flight with it;
+    # results are mapped back to every copy at the end
+    table_keys = [hashlib.md5(table.encode()).hexdigest() for table in tables]
+    unique_tables = dict(zip(table_keys, tables))
+    owned_keys = [key for key in unique_tables if key not in in_flight_tables]
+    for key in owned_keys:
+        in_flight_tables[key] = asyncio.get_running_loop().create_future()
+    futures = {key: in_flight_tables[key] for key in unique_tables}
+
+    try:
+        extracted_tables = await extract_unique_tables([unique_tables[key] for key in owned_keys], filename)
+    except Exception as e:
+        print(f"Failed file {file_path}: {e}")
+        extracted_tables = [
+            {"error": str(e), "table_snippet": unique_tables[key][:100], **({"transient": True} if isinstance(e, RETRYABLE_API_ERRORS) else {})}
+            for key in owned_keys
+        ]
+    for key, result in zip(owned_keys, extracted_tables):
+        futures[key].set_result(result)
+        del in_flight_tables[key]  # Later filings get these from the on-disk cache
+    results_by_key = {key: await future for key, future in futures.items()}
+
+    # Tables the API never answered (transient errors outlasting the backoff) keep the file out of the output,
+    # so the next run redoes it; deterministic failures and exhausted self-healing are written as is
+    failed = sum(result.get("transient", False) for result in results_by_key.values())
+    if failed:
+        print(f"  - {failed} tables of {filename} hit API errors; it will be retried on the next run.")
+        return None
+
+    return {"filename": filename, "extracted_tables": [results_by_key[key] for key in table_keys]}
+
+def load_completed_filenames(output_filename):
+    """Filenames already present in an existing JSONL output (for resuming a crashed run)."""
+    completed = set()
+    if not os.path.exists(output_filename):
+        return completed
+    with open(output_filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                completed.add(json.loads(line)["filename"])
+            except (json.JSONDecodeError, KeyError):
+                continue  # Half-written last line from a crash; that file gets redone
+    return completed
+
+def drop_partial_last_line(output_filename):
+    """Truncates a crash's half-written last line from the JSONL output, so appends start on a fresh line."""
+    if not os.path.exists(output_filename):
+        return
+    with open(output_filename, 'rb+') as f:
+        end = f.seek(0, os.SEEK_END)
+        if end == 0:
+            return
+        f.seek(end - 1)
+        if f.read(1) == b'\n':
+            return
+        position = end  # Walk back a block at a time to the last complete line
+        while position > 0:
+            start = max(0, position - 65536)
+            f.seek(start)
+            newline = f.read(position - start).rfind(b'\n')
+            if newline != -1:
+                f.truncate(start + newline + 1)
+                return
+            position = start
+        f.truncate(0)
+
+async def main(input_path):
     # Ensure output directory exists
     output_dir = "output"
     os.makedirs(output_dir, exist_ok=True)
 
-    output_filename = os.path.join(output_dir, "final_output.json")
+    output_filename = os.path.join(output_dir, "final_output.jsonl")
     if not os.path.exists(input_path):
         print("Input path not found.")
         return
@@ -135,40 +842,27 @@ def main(input_path):
     else:
         files = [input_path]
         base_name = os.path.basename(input_path)
-        output_filename = os.path.join(output_dir, f"{base_name}_extracted.json")
+        output_filename = os.path.join(output_dir, f"{base_name}_extracted.jsonl")
 
-    for file_path in files:
-        print(f"Processing: {file_path}")
-        try:
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                content = f.read()
-            
-            tables = extract_tables_from_html(content)
-            print(f"  - Found {len(tables)} tables.")
-
-            file_record = {"filename": os.path.basename(file_path), "extracted_tables": []}
-
-            for i, table in enumerate(tables):
-                print(f"    - Processing Table {i+1} (Agentic Loop)...")
-                
-                # --- NEW FUNCTION CALL ---
-                extracted_json = process_table_agentic_loop(table, os.path.basename(file_path))
-                
-                file_record["extracted_tables"].append(extracted_json)
-
-            all_data.append(file_record)
-            
-        except Exception as e:
-            print(f"Failed file {file_path}: {e}")
+    drop_partial_last_line(output_filename)
+    completed = load_completed_filenames(output_filename)
+    files = [file_path for file_path in files if os.path.basename(file_path) not in completed]
 
-    # The script writes the entire accumulated list 'all_data' to the JSON file in one go.
-    # It does not append incrementally; it overwrites/creates the file at the end of execution.
-    with open(output_filename, 'w') as f:
-        json.dump(all_data, f, indent=4)
+    # Every table of every file is dispatched together (bounded by llm_semaphore).
+    # Each file is appended as one JSON line as soon as it finishes, so a crash keeps finished work.
+    parse_workers = max(1, min(len(files), os.cpu_count() or 1))
+    with ProcessPoolExecutor(max_workers=parse_workers) as parse_pool, open(output_filename, 'ab') as f:
+        for next_record in asyncio.as_completed([process_file(file_path, parse_pool) for file_path in files]):
+            file_record = await next_record
+            if file_record is not None:
+                f.write(orjson.dumps(file_record, option=orjson.OPT_APPEND_NEWLINE))  # Compact bytes, fastest writer
+                f.flush()
+    if SEMANTIC_CACHE_ENABLED:
+        semantic_cache.save()
     print(f"Done. Saved to {output_filename}")
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
         print("Usage: python3 extract_tables.py <file_or_folder>")
         sys.exit(1)
-    main(sys.argv[1])
\ No newline at end of file
+    asyncio.run(main(sys.argv[1]))
\ No newline at end of file
@@ -2,80 +2,768 @@ import os
 import glob
 import json
 import sys  # <--- Added sys to read command line arguments
-from bs4 import BeautifulSoup
-from openai import OpenAI
+import asyncio
+import time
+import random
+import hashlib
+import re
+import sqlite3
+import copy
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import orjson
+import openai
+import tiktoken
+from lxml import etree, html as lxml_html
+from openai import AsyncOpenAI
 
 # --- CONFIGURATION ---
 # Set your API Key here or in your environment variables
 # os.environ["OPENAI_API_KEY"] = "YOUR_OPENAI_API_KEY_HERE"
-client = OpenAI()
+client = AsyncOpenAI(max_retries=0)  # Retries are handled by call_with_backoff below
 
-# Select a model with a large context window (4o is efficient and smart)
-MODEL = "gpt-4o" 
+# Filling a fixed schema from a table doesn't need the big model; 4o-mini is far cheaper and faster
+MODEL = "gpt-4o-mini"
 
-def extract_tables_from_html(file_content):
+# Cap on how many OpenAI requests may be in flight at once across all files
+MAX_CONCURRENT_REQUESTS = 10
+llm_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+# Account rate limits (defaults match OpenAI usage tier 1 for gpt-4o-mini); raise these for higher tiers
+REQUESTS_PER_MINUTE = 500
+TOKENS_PER_MINUTE = 200000
+ENCODING = tiktoken.encoding_for_model(MODEL)
+
+# Transport-level failures worth retrying; bad requests are not retried
+RETRYABLE_API_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+API_MAX_ATTEMPTS = 5
+API_MAX_BACKOFF_SECONDS = 32
+
+# On-disk cache of model responses, so re-runs and boilerplate tables skip the API entirely
+CACHE_PATH = ".llm_cache.sqlite"
+CACHE_TTL_SECONDS = 30 * 24 * 60 * 60
+cache_db = sqlite3.connect(CACHE_PATH)
+cache_db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, content TEXT NOT NULL, created_at REAL NOT NULL)")
+
+# Semantic cache: reuse the extraction of a table whose embedding is nearly identical to one seen before.
+# Off by default -- near-duplicate tables can differ only in their figures (e.g. another period's numbers).
+SEMANTIC_CACHE_ENABLED = False
+SEMANTIC_CACHE_THRESHOLD = 0.97
+SEMANTIC_CACHE_DIR = ".semantic_cache"
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_MAX_TOKENS = 8000
+
+# Tables are sent as compact text, cut off at this many tokens each
+TABLE_TOKEN_LIMIT = 4000
+RULER_LINE = re.compile(r'^[\s\-=_]*$')
+DOT_LEADER = re.compile(r'(?<=\.)\.{2,}')
+
+# EDGAR filings may contain <PLAINTEXT>, <XMP> or <LISTING>, which libxml2 treats as "everything after this is
+# raw text", silently hiding every later table. Their '<' is escaped before the bytes reach the parser.
+RAW_TEXT_TAG = re.compile(rb'<(/?(?:plaintext|xmp|listing)\b)', re.IGNORECASE)
+RAW_TEXT_TAG_MAX_LENGTH = len(b'</plaintext>')
+READ_BLOCK_SIZE = 1 << 16
+
+# Several tables of a filing are packed into one request, up to BATCH_MAX_TABLES and as long as the
+# estimated JSON answer stays within BATCH_OUTPUT_TOKEN_BUDGET. The answer repeats every cell with quotes,
+# brackets and null padding, so it is estimated at twice the table text plus a fixed cost per table;
+# the budget is half of gpt-4o-mini's 16k output cap, leaving room for estimates that run short.
+BATCH_MAX_TABLES = 8
+BATCH_OUTPUT_TOKEN_BUDGET = 8000
+ANSWER_TOKENS_PER_TABLE_TOKEN = 2
+ANSWER_TOKENS_PER_TABLE = 50
+
+# Structured Outputs: the model is constrained to exactly this shape, so answers always parse.
+# Strict schemas can't have free-form keys, so each row lists its values in the order of "headers".
+TABLE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "table_type": {"type": "string"},
+        "headers": {"type": "array", "items": {"type": "string"}},
+        "rows": {"type": "array", "items": {"type": "array", "items": {"type": ["string", "null"]}}},
+        "footnotes": {"type": "array", "items": {"type": "string"}}
+    },
+    "required": ["table_type", "headers", "rows", "footnotes"],
+    "additionalProperties": False
+}
+BATCH_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "results": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"id": {"type": "integer"}, **TABLE_SCHEMA["properties"]},
+                "required": ["id"] + TABLE_SCHEMA["required"],
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["results"],
+    "additionalProperties": False
+}
+TABLE_RESPONSE_FORMAT = {"type": "json_schema", "json_schema": {"name": "extracted_table", "strict": True, "schema": TABLE_SCHEMA}}
+BATCH_RESPONSE_FORMAT = {"type": "json_schema", "json_schema": {"name": "extracted_tables", "strict": True, "schema": BATCH_SCHEMA}}
+
+class RateLimiter:
     """
-    Parses HTML content and returns a list of stringified <table> blocks.
+    Token-bucket limiter for OpenAI's requests-per-minute and tokens-per-minute caps.
+    Callers pre-debit their prompt size so we wait locally instead of eating 429 backoffs.
+    """
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.request_capacity = requests_per_minute
+        self.token_capacity = tokens_per_minute
+        self.available_requests = requests_per_minute
+        self.available_tokens = tokens_per_minute
+        self.last_refill = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed_minutes = (now - self.last_refill) / 60
+        self.last_refill = now
+        self.available_requests = min(self.request_capacity, self.available_requests + elapsed_minutes * self.request_capacity)
+        self.available_tokens = min(self.token_capacity, self.available_tokens + elapsed_minutes * self.token_capacity)
+
+    async def acquire(self, tokens):
+        # A single oversized prompt can never exceed the bucket, so clamp it to a full minute's budget
+        tokens = min(tokens, self.token_capacity)
+        # Holding the lock while sleeping keeps waiters in FIFO order
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.available_requests >= 1 and self.available_tokens >= tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= tokens
+                    return
+                missing_requests = max(0, 1 - self.available_requests) / self.request_capacity
+                missing_tokens = max(0, tokens - self.available_tokens) / self.token_capacity
+                await asyncio.sleep(max(missing_requests, missing_tokens) * 60)
+
+rate_limiter = RateLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+
+def count_message_tokens(messages):
+    """Approximate prompt size of a chat request, used to pre-debit the token bucket."""
+    return sum(len(ENCODING.encode(message["content"])) for message in messages)
+
+def prompt_cache_key(messages, response_format):
+    """Exact-match key for a request: same model + schema + conversation => same answer at temperature 0."""
+    return hashlib.blake2b((MODEL + json.dumps(response_format) + json.dumps(messages)).encode()).hexdigest()
+
+def cache_get(key):
+    row = cache_db.execute("SELECT content, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+    if row is None or time.time() - row[1] > CACHE_TTL_SECONDS:
+        return None
+    return row[0]
+
+def cache_set(key, content):
+    cache_db.execute("INSERT OR REPLACE INTO responses (key, content, created_at) VALUES (?, ?, ?)", (key, content, time.time()))
+    cache_db.commit()
+
+def table_cache_key(table_text):
+    """
+    Cache key of a single table, whichever request it was extracted in: the key of the
+    one-table request, so equal table text hits the cache across filings and batches.
+    """
+    return prompt_cache_key(table_messages(table_text), TABLE_RESPONSE_FORMAT)
+
+def cached_table_result(table_text):
+    """Extraction of this exact table from an earlier request, or None."""
+    cached = cache_get(table_cache_key(table_text))
+    return None if cached is None else orjson.loads(cached)
+
+class SemanticCache:
+    """
+    Reuses the extraction of a near-duplicate table: embeddings of previously seen
+    tables are kept L2-normalized, so a dot product against them is cosine similarity.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.vectors_path = os.path.join(directory, "vectors.npy")
+        self.responses_path = os.path.join(directory, "responses.json")
+        self.vectors = None
+        self.responses = []
+        if os.path.exists(self.vectors_path) and os.path.exists(self.responses_path):
+            self.vectors = np.load(self.vectors_path)
+            with open(self.responses_path, 'r') as f:
+                self.responses = json.load(f)
+
+    def lookup(self, vector):
+        if not self.responses:
+            return None
+        scores = self.vectors @ vector
+        best = int(np.argmax(scores))
+        if scores[best] < SEMANTIC_CACHE_THRESHOLD:
+            return None
+        return copy.deepcopy(self.responses[best])
+
+    def add(self, vector, response):
+        row = vector.reshape(1, -1)
+        self.vectors = row if self.vectors is None else np.vstack([self.vectors, row])
+        self.responses.append(copy.deepcopy(response))
+
+    def save(self):
+        if self.vectors is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        np.save(self.vectors_path, self.vectors)
+        with open(self.responses_path, 'w') as f:
+            json.dump(self.responses, f)
+
+semantic_cache = SemanticCache(SEMANTIC_CACHE_DIR) if SEMANTIC_CACHE_ENABLED else None
+
+# Tables currently being extracted, keyed by the md5 of their text, each with a future for its result.
+# Boilerplate repeated across filings in one run is sent once; the other filings await that future.
+in_flight_tables = {}
+
+def has_significant_text(table):
+    """
+    Heuristic: Table must have > 100 chars of text to be considered data.
+    Counts the stripped text pieces as it walks them and stops as soon as the bar is
+    cleared, instead of materializing the whole table text just to measure it.
+    """
+    total = 0
+    for text in table.itertext():
+        total += len(text.strip())
+        if total > 100:
+            return True
+    return False
+
+def read_filing_blocks(file_path):
+    """
+    Yields the filing's bytes block by block with raw-text tags (RAW_TEXT_TAG) escaped.
+    A possible tag cut off at the end of a block is held back and finished with the next one.
+    """
+    with open(file_path, 'rb') as f:
+        pending = b''
+        for block in iter(lambda: f.read(READ_BLOCK_SIZE), b''):
+            data = pending + block
+            split = data.rfind(b'<', max(0, len(data) - RAW_TEXT_TAG_MAX_LENGTH))
+            if split == -1:
+                split = len(data)
+            pending = data[split:]
+            yield RAW_TEXT_TAG.sub(rb'&lt;\1', data[:split])
+        yield RAW_TEXT_TAG.sub(rb'&lt;\1', pending)
+
+def extract_tables_from_html(file_path):
+    """
+    Stream-parses an HTML filing from disk and returns a list of stringified <table> blocks.
+    Tables are yielded by lxml as they close and then discarded, so peak memory
+    stays bounded no matter how large the filing is.
     """
-    # Use lxml if installed for speed, otherwise html.parser
-    soup = BeautifulSoup(file_content, 'html.parser')
-    tables = soup.find_all('table')
-    
-    # Filter out tiny tables (often used for formatting/spacing in old HTML)
     significant_tables = []
-    for table in tables:
-        # Heuristic: Table must have > 100 chars of text to be considered data
-        if len(table.get_text(strip=True)) > 100:
-            significant_tables.append(str(table))
+    parser = etree.HTMLPullParser(events=('end',), tag='table', recover=True, encoding='utf-8')
+
+    def take_closed_tables():
+        for _, table in parser.read_events():
+            # Filter out tiny tables (often used for formatting/spacing in old HTML)
+            if has_significant_text(table):
+                significant_tables.append(etree.tostring(table, encoding='unicode', method='html', with_tail=False))
+
+            # Free what we've already consumed; nested tables are freed along with their outermost table
+            if not any(ancestor.tag == 'table' for ancestor in table.iterancestors()):
+                table.clear(keep_tail=True)
+                while table.getprevious() is not None:
+                    del table.getparent()[0]
+
+    for data in read_filing_blocks(file_path):
+        parser.feed(data)
+        take_closed_tables()
+    # Closing the parser also closes a table left open at the end of the file
+    parser.close()
+    take_closed_tables()
             
     return significant_tables
 
-def process_table_with_llm(table_html, filename):
+def compact_table(table_html):
+    """
+    Renders a <table> block as compact plain text and truncates it to TABLE_TOKEN_LIMIT tokens.
+    HTML rows become one line each with cells joined by ' | '. Older SGML-style filings
+    put fixed-width text inside <TABLE>; that text keeps its column layout and only loses
+    ruler lines, dot leaders and its common indent. Either way this is far fewer tokens
+    than the raw markup, and a token-based cut can never leave a half-open tag behind.
+    """
+    table = lxml_html.fragment_fromstring(table_html)
+    lines = []
+    rows = list(table.iter('tr'))
+    if rows:
+        for row in rows:
+            cells = [" ".join(cell.text_content().split()) for cell in row if cell.tag in ('td', 'th')]
+            cells = [cell for cell in cells if cell]
+            if cells:
+                lines.append(" | ".join(cells))
+    else:
+        # Fixed-width table: a value's column is given only by its character position, so the layout is
+        # kept as is. Ruler lines and <S>/<C> marker lines (blank once the tags are gone) are dropped,
+        # dot leaders become spaces of the same width, and the indent shared by every line is removed.
+        for line in table.text_content().expandtabs().splitlines():
+            if not RULER_LINE.match(line):
+                lines.append(DOT_LEADER.sub(lambda leader: " " * len(leader.group()), line.rstrip()))
+        indent = min((len(line) - len(line.lstrip()) for line in lines), default=0)
+        lines = [line[indent:] for line in lines]
+    tokens = ENCODING.encode("\n".join(lines))
+    return ENCODING.decode(tokens[:TABLE_TOKEN_LIMIT])
+
+def load_tables(file_path):
+    """Extracts a filing's significant tables and returns them in their compact, prompt-ready form."""
+    return [compact_table(table_html) for table_html in extract_tables_from_html(file_path)]
+
+async def call_with_backoff(make_request):
+    """
+    Awaits make_request(), retrying transient API failures (rate limits, timeouts,
+    dropped connections, 5xx) with randomized exponential backoff. Anything else,
+    e.g. a BadRequestError, is raised immediately.
+    """
+    for attempt in range(API_MAX_ATTEMPTS):
+        try:
+            return await make_request()
+        except RETRYABLE_API_ERRORS as e:
+            if attempt == API_MAX_ATTEMPTS - 1:
+                raise
+            delay = random.uniform(1, min(API_MAX_BACKOFF_SECONDS, 2 ** attempt))
+            print(f"      ! Transient API error ({type(e).__name__}), retrying in {delay:.1f}s...")
+            await asyncio.sleep(delay)
+
+async def request_completion(messages, response_format):
+    """
+    Sends a chat request to OpenAI, constrained to `response_format`, and returns the parsed JSON answer.
+    The semaphore keeps the number of concurrent HTTP calls bounded and the
+    rate limiter keeps us under the account's RPM/TPM ceiling. Requests seen
+    before are answered from the on-disk cache. A truncated, refused or empty
+    answer raises ValueError and is never cached.
+    """
+    cache_key = prompt_cache_key(messages, response_format)
+    cached = cache_get(cache_key)
+    if cached is not None:
+        return orjson.loads(cached)  # Same dicts as json.loads, several times faster
+
+    prompt_tokens = count_message_tokens(messages)
+
+    async def send():
+        # Wait for rate-limit budget before taking a concurrency slot, so a request throttled
+        # on its bucket never holds a slot that other requests (or other models) could use
+        await rate_limiter.acquire(prompt_tokens)
+        async with llm_semaphore:
+            stream = await client.chat.completions.create(
+                model=MODEL,
+                messages=messages,
+                # Enforce the JSON schema (Structured Outputs)
+                response_format=response_format,
+                temperature=0,
+                stream=True
+            )
+            # Tokens arrive from time-to-first-token onwards instead of all at once at the end;
+            # the event loop keeps serving other requests between chunks
+            parts, refusal, finish_reason = [], [], None
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                if choice.delta.content:
+                    parts.append(choice.delta.content)
+                if choice.delta.refusal:
+                    refusal.append(choice.delta.refusal)
+                if choice.finish_reason:
+                    finish_reason = choice.finish_reason
+        # A refusal or an answer cut off by the output cap ("length") is still a clean stream,
+        # so check how it ended before trusting the JSON
+        if refusal:
+            raise ValueError(f"Model refused the request: {''.join(refusal)}")
+        if finish_reason != "stop":
+            raise ValueError(f"Incomplete response (finish_reason={finish_reason})")
+        content = "".join(parts)
+        if not content:
+            raise ValueError("Empty response")
+        return content
+
+    content = await call_with_backoff(send)
+    response = orjson.loads(content)  # Raises before caching if the answer doesn't parse
+    cache_set(cache_key, content)
+    return response
+
+async def semantic_lookup(table_text):
+    """
+    Embeds the table's visible text and searches the semantic cache.
+    Returns (vector, cached_result); both are None when the cache is disabled or unreachable.
+    """
+    if not SEMANTIC_CACHE_ENABLED:
+        return None, None
+    text = " ".join(table_text.split())
+    text = ENCODING.decode(ENCODING.encode(text)[:EMBEDDING_MAX_TOKENS])
+    try:
+        async def send():
+            async with llm_semaphore:
+                return await client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+        response = await call_with_backoff(send)
+    except Exception as e:
+        print(f"      ! Embedding failed, skipping semantic cache: {e}")
+        return None, None
+    vector = np.asarray(response.data[0].embedding, dtype=np.float32)
+    vector /= np.linalg.norm(vector)
+    return vector, semantic_cache.lookup(vector)
+
+# --- PROMPTS ---
+# Static instructions sent as the first user message of every request, ahead of anything
+# table-specific. OpenAI caches identical prompt prefixes of 1024+ tokens, so keeping this
+# block long, unchanged and in front makes repeat calls cheaper and faster to first token.
+SYSTEM_PROMPT = "You are a helpful assistant that outputs JSON."
+EXTRACTION_INSTRUCTIONS = """
+You are a financial data extraction engine for SEC N-CSR and N-CSRS filings (the annual and
+semi-annual shareholder reports of registered management investment companies).
+
+You will be given one or more tables taken from such a filing, as plain text with one table
+row per line. Tables that were HTML have the columns of each row separated by ' | '. Tables
+that were fixed-width SGML text keep their original layout: there is no separator, and the
+column a value belongs to is the column header it sits under, by character position. A value
+standing under a header belongs to that header even when the columns before it are blank, and
+a "$" in front of a figure is part of that figure, not a column of its own. Leading spaces
+before a row label are the original indentation and usually mean the row is a sub-item of the
+closest less-indented row above it. Ruler lines made of dashes or equals signs and dot leaders
+have been removed. Very long tables may have been cut off at the end; extract what is present
+and never invent the missing rows.
+
+Your Goal: Extract the data into a structured JSON format.
+
+Rules:
+1. Identify the 'table_type'. Prefer one of these names when it fits:
+   - "Schedule of Investments" (holdings, with shares/principal amounts and values)
+   - "Balance Sheet" (statement of assets and liabilities)
+   - "Operations" (statement of operations: investment income, expenses, gains and losses)
+   - "Changes in Net Assets" (statement of changes in net assets, usually two periods)
+   - "Financial Highlights" (per-share data and ratios, usually several years)
+   - "Portfolio Summary" (sector, industry or top-ten holdings breakdowns)
+   - "Other" (anything else: officer and director listings, cover pages, indexes, notes text)
+2. Extract the headers and the rows accurately.
+   - "headers" is the list of column names in order. The first column is usually the row label;
+     call it "Description" when the table gives it no name. Period columns keep the period as
+     printed, for example "June 30, 2003" or "2002".
+   - "rows" is a list of rows, one per data row. Each row is a list of its values in the same
+     order as "headers", so every row has exactly as many entries as there are headers.
+   - Rows that only introduce a group (a label with no values, such as "Assets" or
+     "Investments at value:") are kept as rows with empty values, so the hierarchy survives.
+   - A label that wraps onto a second line belongs to a single row: join the parts with a space.
+3. Keep numbers exactly as printed, but drop currency symbols and thousands separators:
+   "$1,253,973,815" becomes "1253973815". Amounts shown in parentheses are negative:
+   "(1,234)" becomes "-1234". Percentages keep their percent sign: "1.25%".
+   A dash or blank where a value would be means the value is absent; use null.
+4. Never compute, round, or re-total figures. Report only what the table shows.
+5. Footnote markers such as "*", "(a)" or "+" are removed from labels and values. If the table
+   prints the footnote text itself, add it to the "footnotes" list instead of the rows;
+   otherwise "footnotes" is an empty list.
+6. Return ONLY a JSON object with the keys "table_type", "headers", "rows" and "footnotes".
+
+Example input:
+Assets
+Investments* at value:
+  Common stocks (cost $773,592,739) | $923,393,949
+  Short-term investments (cost $113,219,000) | 113,219,000
+Cash | 133,088
+    Total Assets | 1,253,973,815
+Liabilities
+Accrued expenses | 2,667,154
+    Total Liabilities | 171,568,113
+Net Assets | $1,082,405,702
+
+Example output:
+{
+  "table_type": "Balance Sheet",
+  "headers": ["Description", "Amount"],
+  "rows": [
+    ["Assets", null],
+    ["Investments at value:", null],
+    ["Common stocks (cost $773,592,739)", "923393949"],
+    ["Short-term investments (cost $113,219,000)", "113219000"],
+    ["Cash", "133088"],
+    ["Total Assets", "1253973815"],
+    ["Liabilities", null],
+    ["Accrued expenses", "2667154"],
+    ["Total Liabilities", "171568113"],
+    ["Net Assets", "1082405702"]
+  ],
+  "footnotes": []
+}
+
+Example input:
+ | 2003 | 2002
+Net asset value per share | $14.36 | $12.12
+Total net assets | 1,218,862,456 | 1,024,810,092
+Ratio of expenses to average net assets | 0.25% | 0.22%
+Total return | (3.1)% | 19.9%
+
+Example output:
+{
+  "table_type": "Financial Highlights",
+  "headers": ["Description", "2003", "2002"],
+  "rows": [
+    ["Net asset value per share", "14.36", "12.12"],
+    ["Total net assets", "1218862456", "1024810092"],
+    ["Ratio of expenses to average net assets", "0.25%", "0.22%"],
+    ["Total return", "-3.1%", "19.9%"]
+  ],
+  "footnotes": []
+}
+
+Example input:
+                                                  Held
+                          Additions   Reductions  June 30, 2003
+BEA Systems Inc.           305,000                    740,000
+Genentech, Inc.                        75,000         225,000
+
+Example output:
+{
+  "table_type": "Other",
+  "headers": ["Description", "Additions", "Reductions", "Held June 30, 2003"],
+  "rows": [
+    ["BEA Systems Inc.", "305000", null, "740000"],
+    ["Genentech, Inc.", null, "75000", "225000"]
+  ],
+  "footnotes": []
+}
+
+Example input:
+Name, Address and Age | Position Held with Fund | Principal Occupation
+Enrique R. Arzac, 1941 | Director | Professor of Finance, Columbia University
+
+Example output:
+{
+  "table_type": "Other",
+  "headers": ["Name, Address and Age", "Position Held with Fund", "Principal Occupation"],
+  "rows": [
+    ["Enrique R. Arzac, 1941", "Director", "Professor of Finance, Columbia University"]
+  ],
+  "footnotes": []
+}
+"""
+
+def table_messages(table_text):
     """
-    Sends the HTML table to OpenAI to convert to JSON.
+    Chat messages for extracting one table. Only the short trailing message varies; everything
+    before it is a cacheable prefix. It holds nothing but the table, so identical tables in
+    different filings make identical requests.
     """
     prompt = f"""
-    You are a financial data extraction engine. 
-    Analyze the following HTML table from an SEC N-CSR filing ({filename}).
-    
-    Your Goal: Extract the data into a structured JSON format.
-    
-    Rules:
-    1. Identify the 'table_type' (e.g., "Schedule of Investments", "Balance Sheet", "Operations", or "Other").
-    2. Extract the headers and the rows accurately.
-    3. Return ONLY a JSON object.
-    
-    HTML Table:
-    {table_html[:15000]} # Truncating to 15k chars for safety in this simple script version
+    Table:
+    {table_text}
     """
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": EXTRACTION_INSTRUCTIONS},
+        {"role": "user", "content": prompt}
+    ]
 
+async def process_table_with_llm(table_text):
+    """
+    Sends the table (compact text form) to OpenAI to convert to JSON.
+    """
     try:
-        response = client.chat.completions.create(
-            model=MODEL,
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant that outputs JSON."},
-                {"role": "user", "content": prompt}
-            ],
-            # Enforce JSON mode
-            response_format={"type": "json_object"},
-            temperature=0
-        )
-        return json.loads(response.choices[0].message.content)
+        return await request_completion(table_messages(table_text), TABLE_RESPONSE_FORMAT)
     except Exception as e:
         print(f"Error processing table chunk: {e}")
-        return {"error": str(e), "table_snippet": table_html[:100]}
+        error = {"error": str(e), "table_snippet": table_text[:100]}
+        if isinstance(e, RETRYABLE_API_ERRORS):
+            # An outage that outlasted the backoff; anything else (truncation, refusal, bad request) would fail again
+            error["transient"] = True
+        return error
+
+def pack_into_batches(tables):
+    """
+    Greedily groups consecutive tables so that each group has at most BATCH_MAX_TABLES tables and
+    an estimated answer within BATCH_OUTPUT_TOKEN_BUDGET. Returns a list of batches, each a list of
+    indexes into `tables`.
+    """
+    batches = []
+    current_batch, current_tokens = [], 0
+    for i, table_text in enumerate(tables):
+        tokens = ANSWER_TOKENS_PER_TABLE_TOKEN * len(ENCODING.encode(table_text)) + ANSWER_TOKENS_PER_TABLE
+        if current_batch and (len(current_batch) == BATCH_MAX_TABLES or current_tokens + tokens > BATCH_OUTPUT_TOKEN_BUDGET):
+            batches.append(current_batch)
+            current_batch, current_tokens = [], 0
+        current_batch.append(i)
+        current_tokens += tokens
+    if current_batch:
+        batches.append(current_batch)
+    return batches
+
+async def process_table_batch(tables):
+    """
+    Sends several tables to OpenAI in a single request and returns one result per table,
+    in input order. Tables the model skipped or mangled come back as None so the caller can
+    re-dispatch them individually. Each returned table is also cached under its own key.
+    """
+    if len(tables) == 1:
+        return [await process_table_with_llm(tables[0])]
 
-def main(input_path):
-    # This list will hold all extracted data from all files.
-    # The script accumulates data in memory and writes it to a single JSON file at the very end.
-    all_data = []
+    payload = json.dumps({"tables": [{"id": i, "rows": table_text} for i, table_text in enumerate(tables)]})
+    prompt = f"""
+    This request contains several tables. Apply the rules above to each one and return
+    ONLY a JSON object of the form {{"results": [{{"id": <table id>, ...extracted table...}}]}},
+    with exactly one entry per input table.
     
+    Tables (JSON, each with an 'id' and its 'rows'):
+    {payload}
+    """
+
+    try:
+        response = await request_completion([
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": EXTRACTION_INSTRUCTIONS},
+            {"role": "user", "content": prompt}
+        ], BATCH_RESPONSE_FORMAT)
+        results_by_id = {}
+        for result in response.get("results", []):
+            if isinstance(result, dict) and "id" in result:
+                results_by_id[int(result.pop("id"))] = result
+        results = [results_by_id.get(i) for i in range(len(tables))]
+        for table_text, result in zip(tables, results):
+            if result is not None:
+                cache_set(table_cache_key(table_text), orjson.dumps(result).decode())
+        return results
+    except Exception as e:
+        print(f"Error processing batch of {len(tables)} tables, falling back to one request per table: {e}")
+        return [None] * len(tables)
+
+async def extract_unique_tables(tables, filename):
+    """
+    Extracts a filing's distinct tables, packing several tables per request.
+    Returns one result per table, in input order.
+    """
+    # 2. Tables extracted before, in this filing's earlier runs or in any other filing, come from the on-disk cache;
+    # tables that merely look like ones we've already extracted are served from the semantic cache
+    extracted_tables = [cached_table_result(table) for table in tables]
+    uncached = [i for i, result in enumerate(extracted_tables) if result is None]
+    lookups = dict(zip(uncached, await asyncio.gather(*(semantic_lookup(tables[i]) for i in uncached))))
+    for i, (_, cached) in lookups.items():
+        extracted_tables[i] = cached
+    pending = [i for i in uncached if extracted_tables[i] is None]
+
+    # 3. Pack the remaining chunks into batched requests and dispatch them all at once
+    batches = pack_into_batches([tables[i] for i in pending])
+    batch_results = await asyncio.gather(
+        *(process_table_batch([tables[pending[j]] for j in batch]) for batch in batches)
+    )
+    for batch, results in zip(batches, batch_results):
+        for j, result in zip(batch, results):
+            extracted_tables[pending[j]] = result
+
+    # 4. Anything the batched answer missed is retried on its own
+    missing = [i for i in pending if extracted_tables[i] is None]
+    if missing:
+        print(f"    - Re-extracting {len(missing)} tables of {filename} individually...")
+    retried = await asyncio.gather(*(process_table_with_llm(tables[i]) for i in missing))
+    for i, result in zip(missing, retried):
+        extracted_tables[i] = result
+
+    for i in pending:
+        vector = lookups[i][0]
+        if vector is not None and "error" not in extracted_tables[i]:
+            semantic_cache.add(vector, extracted_tables[i])
+
+    return extracted_tables
+
+async def process_file(file_path, parse_pool):
+    """
+    Reads one filing, isolates its tables and extracts them, packing several tables per request.
+    Returns the file record, or None if the file could not be processed.
+    """
+    filename = os.path.basename(file_path)
+    print(f"Processing: {file_path}")
+
+    try:
+        # 1. Chunking Strategy: Isolate Tables (streamed straight from disk)
+        # Reading and parsing are CPU-bound and hold the GIL, so they run in a worker process;
+        # the event loop stays free to drive other files' LLM requests meanwhile
+        tables = await asyncio.get_running_loop().run_in_executor(parse_pool, load_tables, file_path)
+        print(f"  - Found {len(tables)} significant tables in {filename}.")
+    except Exception as e:
+        print(f"Failed to process file {file_path}: {e}")
+        return None
+
+    # Identical tables (repeated boilerplate) are only extracted once and fanned back out at the end,
+    # both within this filing and across the filings in flight alongside it
+    table_keys = [hashlib.md5(table.encode()).hexdigest() for table in tables]
+    unique_tables = dict(zip(table_keys, tables))
+    owned_keys = [key for key in unique_tables if key not in in_flight_tables]
+    for key in owned_keys:
+        in_flight_tables[key] = asyncio.get_running_loop().create_future()
+    futures = {key: in_flight_tables[key] for key in unique_tables}
+
+    try:
+        extracted_tables = await extract_unique_tables([unique_tables[key] for key in owned_keys], filename)
+    except Exception as e:
+        print(f"Failed to process file {file_path}: {e}")
+        extracted_tables = [
+            {"error": str(e), "table_snippet": unique_tables[key][:100], **({"transient": True} if isinstance(e, RETRYABLE_API_ERRORS) else {})}
+            for key in owned_keys
+        ]
+    # Filings that reach these tables later find them in the on-disk cache instead
+    for key, result in zip(owned_keys, extracted_tables):
+        futures[key].set_result(result)
+        del in_flight_tables[key]
+    results_by_key = {key: await future for key, future in futures.items()}
+
+    # A table the API never answered (an outage outlasting the backoff) keeps the whole file
+    # out of the output, so the next run extracts it again instead of skipping it for good.
+    # Deterministic failures are written with their error entry; retrying them would only fail again.
+    failed = sum(result.get("transient", False) for result in results_by_key.values())
+    if failed:
+        print(f"  - {failed} tables of {filename} could not be extracted; it will be retried on the next run.")
+        return None
+
+    return {
+        "filename": filename,
+        "extracted_tables": [results_by_key[key] for key in table_keys]
+    }
+
+def load_completed_filenames(output_filename):
+    """
+    Reads an existing JSONL output and returns the set of filenames already extracted,
+    so an interrupted run can pick up where it left off.
+    """
+    completed = set()
+    if not os.path.exists(output_filename):
+        return completed
+    with open(output_filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                completed.add(json.loads(line)["filename"])
+            except (json.JSONDecodeError, KeyError):
+                # A crash can leave a half-written last line; that file simply gets redone
+                continue
+    return completed
+
+def drop_partial_last_line(output_filename):
+    """
+    Cuts a half-written last line (left behind by a crash mid-write) off an existing JSONL
+    output, so the next appended record starts on a line of its own.
+    """
+    if not os.path.exists(output_filename):
+        return
+    with open(output_filename, 'rb+') as f:
+        end = f.seek(0, os.SEEK_END)
+        if end == 0:
+            return
+        f.seek(end - 1)
+        if f.read(1) == b'\n':
+            return
+        # Walk back a block at a time to the last complete line
+        position = end
+        while position > 0:
+            start = max(0, position - 65536)
+            f.seek(start)
+            newline = f.read(position - start).rfind(b'\n')
+            if newline != -1:
+                f.truncate(start + newline + 1)
+                return
+            position = start
+        f.truncate(0)
+
+async def main(input_path):
     # Ensure output directory exists
     output_dir = "output"
     os.makedirs(output_dir, exist_ok=True)
     
     # Determine output filename based on input
-    output_filename = os.path.join(output_dir, "final_output.json")
+    output_filename = os.path.join(output_dir, "final_output.jsonl")
 
     # Check if input exists
     if not os.path.exists(input_path):
@@ -90,43 +778,31 @@ def main(input_path):
         files = [input_path]
         # Make output name specific to input file
         base_name = os.path.basename(input_path)
-        output_filename = os.path.join(output_dir, f"{base_name}_extracted.json")
+        output_filename = os.path.join(output_dir, f"{base_name}_extracted.jsonl")
 
-    for file_path in files:
-        print(f"Processing: {file_path}")
-        
-        try:
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                content = f.read()
-            
-            # 1. Chunking Strategy: Isolate Tables
-            tables = extract_tables_from_html(content)
-            print(f"  - Found {len(tables)} significant tables.")
+    # Skip files a previous (interrupted) run already wrote out
+    drop_partial_last_line(output_filename)
+    completed = load_completed_filenames(output_filename)
+    if completed:
+        files = [file_path for file_path in files if os.path.basename(file_path) not in completed]
+        print(f"Resuming: {len(completed)} files already extracted, {len(files)} remaining.")
 
-            file_record = {
-                "filename": os.path.basename(file_path),
-                "extracted_tables": []
-            }
-
-            # 2. Loop through chunks
-            for i, table in enumerate(tables):
-                print(f"    - Extracting Table {i+1}/{len(tables)}...")
-                
-                # Call LLM
-                extracted_json = process_table_with_llm(table, os.path.basename(file_path))
-                
-                file_record["extracted_tables"].append(extracted_json)
+    # 3. Save Output Incrementally
+    # Each file record is appended as one JSON line the moment that file finishes,
+    # so nothing accumulates in memory and a crash only loses the files still in flight.
+    parse_workers = max(1, min(len(files), os.cpu_count() or 1))
+    with ProcessPoolExecutor(max_workers=parse_workers) as parse_pool, open(output_filename, 'ab') as f:
+        # All tables across all files are in flight together (bounded by llm_semaphore)
+        for next_record in asyncio.as_completed([process_file(file_path, parse_pool) for file_path in files]):
+            file_record = await next_record
+            if file_record is None:
+                continue
+            # orjson writes compact UTF-8 bytes directly, several times faster than json.dumps
+            f.write(orjson.dumps(file_record, option=orjson.OPT_APPEND_NEWLINE))
+            f.flush()
 
-            all_data.append(file_record)
-            
-        except Exception as e:
-            print(f"Failed to process file {file_path}: {e}")
-
-    # 3. Save Final Output
-    # The script writes the entire accumulated list 'all_data' to the JSON file in one go.
-    # It does not append incrementally; it overwrites/creates the file at the end of execution.
-    with open(output_filename, 'w') as f:
-        json.dump(all_data, f, indent=4)
+    if SEMANTIC_CACHE_ENABLED:
+        semantic_cache.save()
     
     print(f"Extraction complete. Data saved to {output_filename}")
 
@@ -140,4 +816,4 @@ if __name__ == "__main__":
     # Get the filename/folder from the command line argument
     input_arg = sys.argv[1]
     
-    main(input_arg)
\ No newline at end of file
+    asyncio.run(main(input_arg))
\ No newline at end of file